@@ -1,29 +1,121 @@
+import asyncio
 import cv2
+import dlib
 import face_recognition
+from face_recognition.api import _raw_face_landmarks, face_encoder
 import os
 import numpy as np
+import orjson
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, UploadFile, File
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 import csv
+import hashlib
 import io
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _tj = TurboJPEG()
+except (ImportError, OSError):
+    # PyTurboJPEG or libjpeg-turbo missing; fall back to OpenCV decoding
+    _tj = None
+
+try:
+    import faiss
+except ImportError:
+    # Without FAISS, matching falls back to a linear scan (Numba int8 kernel or numpy GEMV)
+    faiss = None
+
+try:
+    from numba import njit
+except ImportError:
+    # Without Numba, matching is a float32 numpy matrix-vector product + argmax
+    njit = None
 
 # --- Configuration ---
 KNOWN_FACES_DIR = "known_faces"
 ATTENDANCE_FILE = "attendance.csv"
-
-app = FastAPI(title="Face Attendance Server")
+ENCODINGS_CACHE = "known_faces.npz"
+# Every path detects at 640x480-equivalent resolution without extra work:
+# faces under ~80px in 640x480 terms (HOG's 80px window) are not found.
+DETECTION_SCALE = 1.0  # uploaded frames are shrunk by this factor before detection
+DETECTION_UPSAMPLE = 0  # uploads and files are detected at their own resolution
+WORKER_COUNT = os.cpu_count() or 1
+STALE_FRAME_SECONDS = 0.5  # frames still queued after this long are dropped
+WS_FRAME_WIDTH, WS_FRAME_HEIGHT = 320, 240  # size of grayscale frames streamed over /ws/frames
+# Streamed frames are half of 640x480, so one upsample restores the same floor
+WS_DETECTION_UPSAMPLE = 1
+TRACK_IOU = 0.5  # boxes overlapping the previous frame by more than this keep their name
+TRACK_REFRESH_FRAMES = 5  # every Nth frame all faces are re-encoded
+HTTP_TRACKER_LIMIT = 64  # most HTTP clients whose last faces are remembered
+MATCH_SIMILARITY = 1 - 0.6 ** 2 / 2  # cosine similarity equal to distance 0.6 on unit vectors
+ATTENDANCE_FLUSH_SECONDS = 0.2  # attendance rows are batched over this window
+HNSW_MIN_FACES = 10000  # galleries at least this large use an approximate HNSW index
 
 # --- Global State ---
 known_face_encodings = []
 known_face_names = []
+known_matrix = np.empty((0, 128), dtype=np.float32)  # encodings of the color images
+known_gray_matrix = np.empty((0, 128), dtype=np.float32)  # same faces encoded from grayscale
+# Matching structures per gallery, see build_gallery: "color" serves color
+# uploads and files, "gray" serves the grayscale /ws/frames stream
+galleries = {}
+_marked_today = set()  # (name, date) pairs already written today
+_marked_date = None
+_attendance_file = None
+_attendance_writer = None
+_attendance_queue = asyncio.Queue()  # (name, date, time) rows waiting for attendance_writer
+_writer_task = None
+executor = None  # process pool running detect_frame/detect_file
+_gate = asyncio.Semaphore(WORKER_COUNT)  # at most one detection in flight per worker
+_http_trackers = OrderedDict()  # client_id -> tracker for /api/process_frame, least recently used first
 
 # --- Helper Functions ---
 
-def load_known_faces():
-    """Loads images from the directory and learns the faces."""
-    global known_face_encodings, known_face_names
+def to_gray_rgb(img):
+    """
+    Drops the color of an RGB or grayscale image but keeps three channels,
+    which is what the grayscale gallery and websocket queries are encoded from.
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+
+def _gallery_hash(files):
+    """Fingerprints the known faces directory from file names and mtimes."""
+    h = hashlib.sha1()
+    # Bump when the way known faces are encoded changes, to invalidate old caches
+    h.update(b"color-gray-v1\n")
+    for file in files:
+        stat = os.stat(os.path.join(KNOWN_FACES_DIR, file))
+        h.update(f"{file}:{stat.st_mtime_ns}:{stat.st_size}\n".encode())
+    return h.hexdigest()
+
+def encode_known_face(file):
+    """Returns the (color, grayscale) encodings of the first face in a known image, or None."""
+    path = os.path.join(KNOWN_FACES_DIR, file)
+    try:
+        image = face_recognition.load_image_file(path)
+        face_locations = face_recognition.face_locations(image)[:1]
+        if not face_locations:
+            return None
+        color = face_recognition.face_encodings(image, face_locations)[0]
+        gray = face_recognition.face_encodings(to_gray_rgb(image), face_locations)[0]
+        return color, gray
+    except Exception as e:
+        print(f"Error loading {file}: {e}")
+        return None
+
+def load_known_faces(pool):
+    """Loads images from the directory and learns the faces, encoding them on pool."""
+    global known_face_encodings, known_face_names, known_matrix, known_gray_matrix
     print(f"Loading faces from {KNOWN_FACES_DIR}...")
     
     if not os.path.exists(KNOWN_FACES_DIR):
@@ -31,97 +123,434 @@ def load_known_faces():
         print(f"Created directory {KNOWN_FACES_DIR}. Please put images there.")
         return
 
-    files = os.listdir(KNOWN_FACES_DIR)
-    for file in files:
-        if file.lower().endswith(('.jpg', '.jpeg', '.png')):
-            path = os.path.join(KNOWN_FACES_DIR, file)
-            try:
-                image = face_recognition.load_image_file(path)
-                encodings = face_recognition.face_encodings(image)
-                if encodings:
-                    known_face_encodings.append(encodings[0])
-                    name = os.path.splitext(file)[0]
-                    known_face_names.append(name)
-                    print(f"Loaded: {name}")
-            except Exception as e:
-                print(f"Error loading {file}: {e}")
+    files = sorted(f for f in os.listdir(KNOWN_FACES_DIR) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    gallery_hash = _gallery_hash(files)
+
+    # Reuse the cached encodings if the directory hasn't changed
+    cache_hit = False
+    if os.path.isfile(ENCODINGS_CACHE):
+        try:
+            with np.load(ENCODINGS_CACHE) as cache:
+                if str(cache["hash"]) == gallery_hash:
+                    known_matrix = np.ascontiguousarray(cache["enc"], dtype=np.float32).reshape(-1, 128)
+                    known_gray_matrix = np.ascontiguousarray(cache["enc_gray"], dtype=np.float32).reshape(-1, 128)
+                    known_face_names = cache["names"].tolist()
+                    known_face_encodings = list(known_matrix)
+                    cache_hit = True
+        except Exception as e:
+            print(f"Error reading {ENCODINGS_CACHE}: {e}")
+
+    if cache_hit:
+        print(f"Loaded {len(known_face_names)} faces from {ENCODINGS_CACHE}")
+    else:
+        # One image per worker process; results come back in file order
+        gray_encodings = []
+        for file, encoding in zip(files, pool.map(encode_known_face, files)):
+            if encoding is not None:
+                known_face_encodings.append(encoding[0])
+                gray_encodings.append(encoding[1])
+                name = os.path.splitext(file)[0]
+                known_face_names.append(name)
+                print(f"Loaded: {name}")
+
+        # Stack once so matching is a single vectorized pass per face
+        if known_face_encodings:
+            known_matrix = np.ascontiguousarray(np.vstack(known_face_encodings), dtype=np.float32)
+            known_gray_matrix = np.ascontiguousarray(np.vstack(gray_encodings), dtype=np.float32)
+        try:
+            np.savez_compressed(ENCODINGS_CACHE, enc=known_matrix, enc_gray=known_gray_matrix, names=np.array(known_face_names, dtype=str), hash=gallery_hash)
+        except Exception as e:
+            print(f"Error writing {ENCODINGS_CACHE}: {e}")
+
+    galleries["color"] = build_gallery(known_matrix)
+    galleries["gray"] = build_gallery(known_gray_matrix)
+
+def build_gallery(matrix):
+    """
+    Precomputes what find_best_match needs for one set of known encodings:
+    the unit-norm rows, their int8 copy and scales, and a FAISS index.
+    """
+    gallery = {"norm": np.empty((0, 128), dtype=np.float32), "q": None, "inv_scale": None, "index": None}
+    if len(matrix) == 0:
+        return gallery
+
+    gallery["norm"] = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    if njit is not None:
+        # Only the Numba kernel has a real int8 dot; numpy matches on the float rows
+        gallery["q"], row_scale = quantize(gallery["norm"])
+        gallery["inv_scale"] = (1.0 / row_scale).astype(np.float32)
+    gallery["index"] = build_index(gallery["norm"])
+    return gallery
+
+def quantize(vectors):
+    """Scales each row to the int8 range; returns the int8 rows and their scales."""
+    scale = 127.0 / np.abs(vectors).max(axis=-1, keepdims=True)
+    q = np.clip(np.round(vectors * scale), -127, 127).astype(np.int8)
+    return q, scale.squeeze(-1)
+
+def build_index(vectors):
+    """Builds a FAISS inner-product index over unit vectors, or None without faiss."""
+    if faiss is None:
+        return None
+
+    dim = vectors.shape[1]
+    if len(vectors) >= HNSW_MIN_FACES:
+        # Graph search visits O(log N) faces instead of all of them
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexFlatIP(dim)
+    index.add(vectors)
+    return index
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _best_match_kernel(known_q, inv_scale, query_q):
+        """Fused int8 dot, rescale and argmax in one pass over the gallery."""
+        # Serial on purpose: a prange loop would race on the running best
+        best_i = -1
+        best_s = -np.inf
+        for i in range(known_q.shape[0]):
+            acc = 0
+            for j in range(known_q.shape[1]):
+                acc += np.int32(known_q[i, j]) * np.int32(query_q[j])
+            s = acc * inv_scale[i]
+            if s > best_s:
+                best_s = s
+                best_i = i
+        return best_i, best_s
+
+def warm_up_matcher():
+    """Compiles the Numba kernel at startup instead of on the first recognized face."""
+    if njit is not None:
+        # Same dtypes and layouts as find_best_match, so this is the signature reused later
+        _best_match_kernel(np.zeros((1, 128), dtype=np.int8), np.ones(1, dtype=np.float32), np.zeros(128, dtype=np.int8))
+
+def find_best_match(face_encoding, gallery="color"):
+    """Returns the name of the most similar face in the given gallery, or "Unknown"."""
+    known = galleries.get(gallery)
+    if known is None or len(known["norm"]) == 0:
+        return "Unknown"
+
+    # On unit vectors a single matrix-vector product ranks the same as distance
+    query = face_encoding.astype(np.float32)
+    query /= np.linalg.norm(query)
+
+    if known["index"] is not None:
+        sims, ids = known["index"].search(query[None, :], 1)
+        best_match_index, best_sim = ids[0, 0], sims[0, 0]
+    elif njit is not None:
+        query_q, query_scale = quantize(query)
+        best_match_index, best_sim = _best_match_kernel(known["q"], known["inv_scale"], query_q)
+        best_sim /= query_scale
+    else:
+        # Float32 GEMV through BLAS; numpy has no int8 kernel to use the int8 rows with
+        sims = known["norm"] @ query
+        best_match_index = sims.argmax()
+        best_sim = sims[best_match_index]
+
+    if best_match_index >= 0 and best_sim > MATCH_SIMILARITY:
+        return known_face_names[best_match_index]
+    return "Unknown"
+
+def decode_frame(contents):
+    """Decodes JPEG bytes from the browser into an RGB image."""
+    if _tj is not None:
+        # libjpeg-turbo decodes straight to RGB, no extra color conversion pass
+        return _tj.decode(contents, pixel_format=TJPF_RGB)
+
+    # frombuffer is a zero-copy view over the bytes
+    nparr = np.frombuffer(contents, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    # Convert BGR (OpenCV) to RGB (face_recognition)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+def encode_faces(rgb_img, face_locations):
+    """Computes the 128-d encodings for all faces in one dlib call."""
+    if not face_locations:
+        return []
+
+    # Hand dlib every landmark set at once so it loops in C++, not Python
+    landmarks = dlib.full_object_detections()
+    landmarks.extend(_raw_face_landmarks(rgb_img, face_locations, model="small"))
+    descriptors = face_encoder.compute_face_descriptor(rgb_img, landmarks, 1)
+    return [np.array(d) for d in descriptors]
+
+def box_iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes."""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    if inter == 0:
+        return 0.0
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return inter / (area_a + area_b - inter)
+
+def detect_faces(img, tracked_boxes=(), upsample=DETECTION_UPSAMPLE):
+    """
+    Returns the face locations in an RGB or grayscale image, the index of
+    the tracked box each one overlaps (-1 if none), and the encodings of
+    the untracked faces (None for tracked ones).
+    """
+    face_locations = face_recognition.face_locations(img, number_of_times_to_upsample=upsample, model="hog")
+    if not face_locations:
+        return [], [], []
+
+    # Faces that barely moved keep their previous name and skip the encoder
+    tracked = []
+    for location in face_locations:
+        ious = [box_iou(location, box) for box in tracked_boxes]
+        best = int(np.argmax(ious)) if ious else -1
+        tracked.append(best if best >= 0 and ious[best] > TRACK_IOU else -1)
+
+    untracked = [loc for loc, t in zip(face_locations, tracked) if t < 0]
+    if untracked and img.ndim == 2:
+        # HOG detects on grayscale, but the encoder needs three channels
+        img = to_gray_rgb(img)
+    encodings = iter(encode_faces(img, untracked))
+    face_encodings = [next(encodings) if t < 0 else None for t in tracked]
+    return face_locations, tracked, face_encodings
+
+def detect_frame(contents, tracked_boxes=()):
+    """Worker task: runs detect_faces on a JPEG frame uploaded by the browser."""
+    img = decode_frame(contents)
+
+    # Shrink before detection: HOG cost scales with the pixel count
+    if DETECTION_SCALE != 1.0:
+        img = cv2.resize(img, (0, 0), fx=DETECTION_SCALE, fy=DETECTION_SCALE, interpolation=cv2.INTER_AREA)
+    return detect_faces(img, tracked_boxes)
+
+def detect_gray_frame(buf, tracked_boxes=()):
+    """Worker task: runs detect_faces on a raw grayscale frame from the websocket."""
+    gray = np.frombuffer(buf, np.uint8).reshape(WS_FRAME_HEIGHT, WS_FRAME_WIDTH)
+    return detect_faces(gray, tracked_boxes, upsample=WS_DETECTION_UPSAMPLE)
+
+def detect_file(file_path):
+    """Worker task: returns the face encodings found in an image on disk."""
+    image = face_recognition.load_image_file(file_path)
+    face_locations = face_recognition.face_locations(image, number_of_times_to_upsample=DETECTION_UPSAMPLE, model="hog")
+    if not face_locations:
+        return []
+    return encode_faces(image, face_locations)
+
+def http_tracker(client_id):
+    """Returns the tracker of an HTTP client; without an id, a fresh one (no tracking)."""
+    if not client_id:
+        return {"faces": [], "frames": 0}
+
+    tracker = _http_trackers.pop(client_id, None) or {"faces": [], "frames": 0}
+    _http_trackers[client_id] = tracker
+    if len(_http_trackers) > HTTP_TRACKER_LIMIT:
+        _http_trackers.popitem(last=False)
+    return tracker
+
+def next_tracks(tracker):
+    """Returns the (box, name) pairs the next frame may reuse."""
+    # Re-encode every face now and then so a stale track can't stick
+    tracker["frames"] += 1
+    if tracker["frames"] >= TRACK_REFRESH_FRAMES or not tracker["faces"]:
+        tracker["frames"] = 0
+        return []
+    return tracker["faces"]
+
+def label_faces(tracker, prev_faces, face_locations, tracked, face_encodings, gallery="color"):
+    """Names each detected face against gallery, marks attendance and updates the tracker."""
+    faces = []
+    for location, track, face_encoding in zip(face_locations, tracked, face_encodings):
+        name = prev_faces[track][1] if track >= 0 else find_best_match(face_encoding, gallery)
+        mark_attendance(name)
+        faces.append((location, name))
+
+    # Only recognized faces are tracked; unknowns get another look next frame.
+    # The list is replaced, never mutated, so in-flight frames keep their snapshot.
+    tracker["faces"] = [(location, name) for location, name in faces if name != "Unknown"]
+    return faces
+
+def load_attendance():
+    """Opens the attendance log and remembers who is already marked today."""
+    global _attendance_file, _attendance_writer, _marked_date
+    _marked_date = datetime.now().strftime("%Y-%m-%d")
+    _marked_today.clear()
+
+    file_exists = os.path.isfile(ATTENDANCE_FILE)
+    if file_exists:
+        with open(ATTENDANCE_FILE, 'r') as f:
+            reader = csv.reader(f)
+            for row in reader:
+                if len(row) >= 2 and row[1] == _marked_date:
+                    _marked_today.add((row[0], row[1]))
+
+    # Keep one handle open; attendance_writer flushes it once per batch
+    _attendance_file = open(ATTENDANCE_FILE, 'a', newline='')
+    _attendance_writer = csv.writer(_attendance_file)
+    if not file_exists:
+        _attendance_writer.writerow(["Name", "Date", "Time"])
 
 def mark_attendance(name):
-    """Writes the name and timestamp to a CSV file."""
+    """Queues the name and timestamp for the CSV file."""
+    global _marked_date
     if name == "Unknown":
         return
 
     now = datetime.now()
     date_string = now.strftime("%Y-%m-%d")
     time_string = now.strftime("%H:%M:%S")
-    
-    file_exists = os.path.isfile(ATTENDANCE_FILE)
+
+    # Forget yesterday's entries once the date rolls over
+    if date_string != _marked_date:
+        _marked_today.clear()
+        _marked_date = date_string
     
     # Check if already marked today
-    already_marked = False
-    if file_exists:
-        with open(ATTENDANCE_FILE, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if row and row[0] == name and row[1] == date_string:
-                    already_marked = True
-                    break
-    
-    if not already_marked:
-        with open(ATTENDANCE_FILE, 'a', newline='') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                writer.writerow(["Name", "Date", "Time"])
-            writer.writerow([name, date_string, time_string])
+    if (name, date_string) in _marked_today:
+        return
+
+    _marked_today.add((name, date_string))
+    _attendance_queue.put_nowait((name, date_string, time_string))
+
+def write_attendance_rows(rows):
+    """Appends rows to the attendance CSV and syncs them to disk."""
+    _attendance_writer.writerows(rows)
+    _attendance_file.flush()
+    os.fsync(_attendance_file.fileno())
+    for name, _, _ in rows:
         print(f"Attendance marked for: {name}")
 
-# --- Startup Event ---
-@app.on_event("startup")
-async def startup_event():
-    load_known_faces()
+async def attendance_writer():
+    """Background task: drains the attendance queue in batches until it reads None."""
+    while True:
+        batch = [await _attendance_queue.get()]
+        # Let marks from the same burst pile up into one write
+        await asyncio.sleep(ATTENDANCE_FLUSH_SECONDS)
+        while not _attendance_queue.empty():
+            batch.append(_attendance_queue.get_nowait())
+
+        rows = [row for row in batch if row is not None]
+        if rows:
+            try:
+                await asyncio.to_thread(write_attendance_rows, rows)
+            except Exception as e:
+                print(f"Error writing {ATTENDANCE_FILE}: {e}")
+                # Forget these marks so the next sighting queues them again
+                for name, date_string, _ in rows:
+                    _marked_today.discard((name, date_string))
+        if len(rows) < len(batch):
+            return
+
+# --- App Lifespan ---
+@asynccontextmanager
+async def lifespan(app):
+    """Loads the gallery and starts the workers, then tears them down on exit."""
+    global executor, _writer_task
+    # Spawned workers keep dlib off the event loop and outside the GIL;
+    # they encode the gallery first, then serve detection requests
+    executor = ProcessPoolExecutor(max_workers=WORKER_COUNT, mp_context=multiprocessing.get_context("spawn"))
+    load_known_faces(executor)
+    warm_up_matcher()
+    load_attendance()
+    _writer_task = asyncio.create_task(attendance_writer())
+
+    yield
+
+    executor.shutdown(wait=False, cancel_futures=True)
+    # None tells the writer to flush what's left and stop
+    _attendance_queue.put_nowait(None)
+    try:
+        await _writer_task
+    finally:
+        _attendance_file.close()
+
+app = FastAPI(title="Face Attendance Server", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- API Endpoints ---
 
 @app.post("/api/process_frame")
-async def process_frame(file: UploadFile = File(...)):
+async def process_frame(file: UploadFile = File(...), client_id: Optional[str] = Form(None)):
     """
     Receives an image file from the browser, detects faces, 
     marks attendance, and returns the face locations/names.
+    Faces are only tracked between frames that carry the same client_id.
     """
-    # Read image bytes
-    contents = await file.read()
-    
-    # Convert bytes to numpy array for OpenCV
-    nparr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    # Convert BGR (OpenCV) to RGB (face_recognition)
-    rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    
-    # Detect faces
-    face_locations = face_recognition.face_locations(rgb_img)
-    face_encodings = face_recognition.face_encodings(rgb_img, face_locations)
+    received = time.monotonic()
 
-    results = []
+    async with _gate:
+        # Frames that waited too long are obsolete; drop them instead of piling up
+        if time.monotonic() - received > STALE_FRAME_SECONDS:
+            return Response(status_code=204)
 
-    for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
-        matches = face_recognition.compare_faces(known_face_encodings, face_encoding)
-        name = "Unknown"
+        # Read image bytes only after the stale check, so dropped frames are never read
+        contents = await file.read()
 
-        face_distances = face_recognition.face_distance(known_face_encodings, face_encoding)
-        if len(face_distances) > 0:
-            best_match_index = np.argmin(face_distances)
-            if matches[best_match_index]:
-                name = known_face_names[best_match_index]
+        tracker = http_tracker(client_id)
+        prev_faces = next_tracks(tracker)
 
-        mark_attendance(name)
+        # Decode, detect and encode in a worker; matching against the gallery stays here
+        loop = asyncio.get_running_loop()
+        detections = await loop.run_in_executor(
+            executor, detect_frame, contents, [box for box, _ in prev_faces])
+
+    # Empty room: nothing to match, mark or scale
+    if not detections[0]:
+        tracker["faces"] = []
+        return {"faces": []}
+
+    results = []
+
+    for location, name in label_faces(tracker, prev_faces, *detections):
+        # Scale the box back up to the original frame size
+        top, right, bottom, left = (int(round(v / DETECTION_SCALE)) for v in location)
         
         results.append({
             "name": name,
             "box": [top, right, bottom, left] # Return coordinates to draw on frontend
         })
 
-    return JSONResponse(content={"faces": results})
+    return {"faces": results}
+
+async def send_json(websocket, payload):
+    """Sends a JSON text message serialized with orjson."""
+    await websocket.send_text(orjson.dumps(payload).decode())
+
+@app.websocket("/ws/frames")
+async def frames_socket(websocket: WebSocket):
+    """
+    Streams raw grayscale frames (WS_FRAME_WIDTH x WS_FRAME_HEIGHT, one byte
+    per pixel) from the browser and answers each with the faces found in it.
+    """
+    await websocket.accept()
+    tracker = {"faces": [], "frames": 0}
+    loop = asyncio.get_running_loop()
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            buf = message.get("bytes")
+            if buf is None:
+                await send_json(websocket, {"error": "Expected a binary frame", "faces": []})
+                continue
+            if len(buf) != WS_FRAME_WIDTH * WS_FRAME_HEIGHT:
+                await send_json(websocket, {"error": "Unexpected frame size", "faces": []})
+                continue
+
+            async with _gate:
+                prev_faces = next_tracks(tracker)
+                detections = await loop.run_in_executor(
+                    executor, detect_gray_frame, buf, [box for box, _ in prev_faces])
+
+            if not detections[0]:
+                tracker["faces"] = []
+                await send_json(websocket, {"faces": []})
+                continue
+
+            # Boxes stay in frame coordinates; the client scales them to its overlay
+            # Grayscale queries are matched against the grayscale gallery
+            faces = label_faces(tracker, prev_faces, *detections, gallery="gray")
+            await send_json(websocket, {"faces": [{"name": name, "box": list(location)} for location, name in faces]})
+    except WebSocketDisconnect:
+        pass
 
 @app.post("/api/recognize_from_file")
 async def recognize_from_file(file_path: str):
@@ -129,31 +558,24 @@ async def recognize_from_file(file_path: str):
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
     
-    image = face_recognition.load_image_file(file_path)
-    face_locations = face_recognition.face_locations(image)
-    face_encodings = face_recognition.face_encodings(image, face_locations)
+    async with _gate:
+        loop = asyncio.get_running_loop()
+        face_encodings = await loop.run_in_executor(executor, detect_file, file_path)
+
+    if not face_encodings:
+        return {"results": []}
     
     results = []
     for face_encoding in face_encodings:
-        matches = face_recognition.compare_faces(known_face_encodings, face_encoding)
-        name = "Unknown"
-        face_distances = face_recognition.face_distance(known_face_encodings, face_encoding)
-        if len(face_distances) > 0:
-            best_match_index = np.argmin(face_distances)
-            if matches[best_match_index]:
-                name = known_face_names[best_match_index]
-        
+        name = find_best_match(face_encoding)
         mark_attendance(name)
         results.append({"name": name})
         
     return {"results": results}
 
-@app.get("/")
-async def index():
-    """
-    Serves the HTML page that accesses the Laptop Camera using JavaScript.
-    """
-    html_content = """
+# --- Web Page ---
+
+INDEX_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -184,7 +606,8 @@ async def index():
             navigator.mediaDevices.getUserMedia({ video: true })
                 .then(stream => {
                     video.srcObject = stream;
-                    statusDiv.innerText = "Camera Active. Sending frames to server...";
+                    statusDiv.innerText = "Camera Active. Streaming frames to server...";
+                    connect();
                     // Start the loop
                     setInterval(sendFrameToServer, 1000); // Send 1 frame every second
                 })
@@ -194,41 +617,69 @@ async def index():
                     statusDiv.style.color = "red";
                 });
 
-            // 2. Function to capture frame and send to Python
+            // 2. Stream small grayscale frames over a WebSocket
+            // Must match WS_FRAME_WIDTH / WS_FRAME_HEIGHT on the server
+            const FRAME_W = 320, FRAME_H = 240;
+            const frameCanvas = document.createElement('canvas');
+            frameCanvas.width = FRAME_W;
+            frameCanvas.height = FRAME_H;
+            const frameCtx = frameCanvas.getContext('2d', { willReadFrequently: true });
+            const gray = new Uint8Array(FRAME_W * FRAME_H);
+            let ws = null;
+            let busy = false; // one frame in flight at a time
+            let crop = null;  // part of the video the in-flight frame was cut from
+
+            function connect() {
+                const scheme = location.protocol === 'https:' ? 'wss://' : 'ws://';
+                ws = new WebSocket(scheme + location.host + '/ws/frames');
+                ws.onmessage = event => {
+                    busy = false;
+                    // Map boxes from the 320x240 frame back onto the uncropped video
+                    const kx = crop.w / FRAME_W, ky = crop.h / FRAME_H;
+                    const faces = JSON.parse(event.data).faces.map(face => {
+                        const [top, right, bottom, left] = face.box;
+                        return {
+                            name: face.name,
+                            box: [crop.y + top * ky, crop.x + right * kx, crop.y + bottom * ky, crop.x + left * kx]
+                        };
+                    });
+                    drawBoxes(faces, video.videoWidth, video.videoHeight);
+                };
+                ws.onclose = () => {
+                    busy = false;
+                    setTimeout(connect, 1000); // Reconnect after a server restart
+                };
+                ws.onerror = err => console.error("Server error:", err);
+            }
+
             function sendFrameToServer() {
-                // Create a temporary canvas to capture the frame
-                const tempCanvas = document.createElement('canvas');
-                tempCanvas.width = video.videoWidth;
-                tempCanvas.height = video.videoHeight;
-                const tempCtx = tempCanvas.getContext('2d');
-                tempCtx.drawImage(video, 0, 0);
-
-                // Convert to Blob (JPG)
-                tempCanvas.toBlob(blob => {
-                    const formData = new FormData();
-                    formData.append('file', blob, 'frame.jpg');
-
-                    // Send to Python API
-                    fetch('/api/process_frame', {
-                        method: 'POST',
-                        body: formData
-                    })
-                    .then(response => response.json())
-                    .then(data => {
-                        drawBoxes(data.faces);
-                    })
-                    .catch(err => console.error("Server error:", err));
-                }, 'image/jpeg', 0.8);
+                if (busy || !ws || ws.readyState !== WebSocket.OPEN) return;
+
+                // Center-crop the video to 4:3 so faces aren't squeezed by the downscale
+                const vw = video.videoWidth, vh = video.videoHeight;
+                const w = Math.min(vw, vh * FRAME_W / FRAME_H);
+                const h = Math.min(vh, vw * FRAME_H / FRAME_W);
+                crop = { x: (vw - w) / 2, y: (vh - h) / 2, w: w, h: h };
+
+                // Downscale onto the offscreen canvas and keep only luminance
+                frameCtx.drawImage(video, crop.x, crop.y, crop.w, crop.h, 0, 0, FRAME_W, FRAME_H);
+                const rgba = frameCtx.getImageData(0, 0, FRAME_W, FRAME_H).data;
+                for (let i = 0, j = 0; i < gray.length; i++, j += 4) {
+                    gray[i] = (rgba[j] * 77 + rgba[j + 1] * 150 + rgba[j + 2] * 29) >> 8;
+                }
+
+                busy = true;
+                ws.send(gray);
             }
 
             // 3. Draw boxes based on Server Response
-            function drawBoxes(faces) {
+            function drawBoxes(faces, frameWidth, frameHeight) {
                 // Clear previous drawings
                 ctx.clearRect(0, 0, overlay.width, overlay.height);
                 
-                // Adjust scale if video size differs from display size
-                const scaleX = overlay.width / video.videoWidth;
-                const scaleY = overlay.height / video.videoHeight;
+                // Adjust scale if the frame size differs from display size
+                const scaleX = overlay.width / frameWidth;
+                const scaleY = overlay.height / frameHeight;
 
                 faces.forEach(face => {
                     const [top, right, bottom, left] = face.box;
@@ -253,7 +704,16 @@ async def index():
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
+
+# Built once at import; every page load reuses the same encoded body
+_INDEX_RESPONSE = HTMLResponse(content=INDEX_HTML, headers={"Cache-Control": "public, max-age=3600"})
+
+@app.get("/")
+async def index():
+    """
+    Serves the HTML page that accesses the Laptop Camera using JavaScript.
+    """
+    return _INDEX_RESPONSE
 
 if __name__ == "__main__":
     import uvicorn